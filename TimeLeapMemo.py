@@ -2,7 +2,7 @@
 # PyQt6 + moderngl demo: Forgetful drawing with GPU density map and homeostatic feedback.
 # Draw with mouse (left button). Press 'C' to clear. Use slider to set target density (0..1).
 
-import sys, time, math
+import sys, time, math, struct
 from dataclasses import dataclass
 from typing import List, Tuple
 import numpy as np
@@ -13,53 +13,71 @@ from PyQt6.QtCore import Qt, QPointF, QTimer
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QSlider, QLabel, QWidget, QHBoxLayout, QVBoxLayout, QPushButton, QFileDialog, QStackedLayout
 )
-from PyQt6.QtGui import QSurfaceFormat, QPainter, QPen, QColor, QPainterPath
+from PyQt6.QtGui import QSurfaceFormat, QPainter, QPen, QColor, QPolygonF
 from PyQt6.QtOpenGLWidgets import QOpenGLWidget
 import moderngl
 
 
 # ---- Utility: simple smoothing by midpoint quadratic conversion ----
 def flatten_quadratic_bezier(p0, p1, p2, tol=0.5):
-    pts = []
-
-    def _flat(a, b, c):
-        mx = (a[0] + c[0]) / 2.0
-        my = (a[1] + c[1]) / 2.0
-        bx = (a[0] + 2 * b[0] + c[0]) / 4.0
-        by = (a[1] + 2 * b[1] + c[1]) / 4.0
-        dx = bx - mx
-        dy = by - my
-        return dx * dx + dy * dy
-
-    def _recurse(a, b, c):
-        if _flat(a, b, c) <= tol * tol:
-            pts.append(c)
-            return
-        ab = ((a[0] + b[0]) / 2.0, (a[1] + b[1]) / 2.0)
-        bc = ((b[0] + c[0]) / 2.0, (b[1] + c[1]) / 2.0)
-        abc = ((ab[0] + bc[0]) / 2.0, (ab[1] + bc[1]) / 2.0)
-        _recurse(a, ab, abc)
-        _recurse(abc, bc, c)
-
-    pts.append(p0)
-    _recurse(p0, p1, p2)
-    return pts
+    # 再帰分割の代わりに、初期平坦度から必要な分割数を見積もり、
+    # 一様なtグリッド上でベジェ式をNumPyで一括評価する((n,2)配列を返す)
+    a = np.asarray(p0[:2], dtype=np.float32)
+    b = np.asarray(p1[:2], dtype=np.float32)
+    c = np.asarray(p2[:2], dtype=np.float32)
+    # 弦の中点と曲線の中点(t=0.5)のずれが最大偏差の目安
+    dev = (a + 2.0 * b + c) / 4.0 - (a + c) / 2.0
+    flatness = math.hypot(float(dev[0]), float(dev[1]))
+    # 偏差は分割数の2乗で縮むので n ~ sqrt(flatness / tol)
+    n = max(2, int(math.sqrt(flatness / tol)) + 2)
+    t = np.linspace(0.0, 1.0, n, dtype=np.float32)[:, None]
+    return (1.0 - t) ** 2 * a + 2.0 * (1.0 - t) * t * b + t * t * c
+
+
+def midpoint_polyline(pts):
+    # quadTo列と同等の(制御点, 弦中点)系列をNumPyで一括生成したポリライン
+    if len(pts) < 3:
+        poly_pts = pts
+    else:
+        ctrl = pts[1:-1]
+        mid = (pts[1:-1] + pts[2:]) * 0.5
+        poly_pts = np.empty((1 + 2 * len(ctrl), 2), dtype=np.float32)
+        poly_pts[0] = pts[0]
+        poly_pts[1::2] = ctrl
+        poly_pts[2::2] = mid
+    return QPolygonF([QPointF(float(x), float(y)) for x, y in poly_pts])
 
 
 # ---- Data model for strokes ----
+# SoA化: 点列はPythonタプルのリストではなく連続したNumPy配列で持つ
 @dataclass
 class Stroke:
-    points: List[Tuple[float, float, float]]  # (x, y, pressure)
+    points_xy: np.ndarray  # (N, 2) f4 の座標列
+    pressure: np.ndarray   # (N,) f4 の筆圧列
     width: float
     color: Tuple[float, float, float]
     time_created: float
-    base_alpha: float = 1.0  # dynamic alpha for forgetting
-    is_visible: bool = True  # optimization flag
+    # 減衰アルファと可視フラグはGLCanvas側のSoA配列(_base_alpha/_visible)が唯一の実体
+    _seg_cache: np.ndarray = None  # セグメントレコードのキャッシュ(解像度非依存のため無効化不要)
+    _qpoly: QPolygonF = None  # Qt描画用ポリライン(点列は確定後に変化しないため無効化不要)
+    _bbox: np.ndarray = None  # (x0, y0, x1, y1) のAABBキャッシュ
+
+    def __len__(self):
+        return len(self.points_xy)
+
+    def polyline(self):
+        # ポリライン近似を一度だけ構築してキャッシュする
+        if self._qpoly is None:
+            self._qpoly = midpoint_polyline(self.points_xy)
+        return self._qpoly
 
     def bbox(self):
-        xs = [p[0] for p in self.points]
-        ys = [p[1] for p in self.points]
-        return min(xs), min(ys), max(xs), max(ys)
+        if self._bbox is None:
+            self._bbox = np.concatenate(
+                [self.points_xy.min(0), self.points_xy.max(0)]
+            ).astype(np.float32)
+        x0, y0, x1, y1 = self._bbox
+        return float(x0), float(y0), float(x1), float(y1)
 
 
 # ---- GL Canvas Widget ----
@@ -68,11 +86,6 @@ class GLCanvas(QOpenGLWidget):
         super().__init__(parent)
         self.setMouseTracking(True)
 
-        self.strokes: List[Stroke] = []
-        self.current_points = []
-        self.density_w = density_w
-        self.density_h = density_h
-
         # homeostasis parameters
         self.target_density = 0.05  # 目標密度を下げる
         self.hysteresis = 0.02      # より敏感に反応
@@ -80,6 +93,44 @@ class GLCanvas(QOpenGLWidget):
         self.lambda_k = 3.0         # 密度による影響を強く
         self.lambdas_factor = 1.0
 
+        self.strokes: List[Stroke] = []
+        # 減衰計算用SoA配列は高水位まで事前確保し、_n_strokesカーソルで追記する
+        # (ストロークごとの配列再確保をなくし、先頭からの連続領域だけを使う)
+        self._n_strokes = 0
+        cap = 65536
+        self._time_created = np.zeros(cap, dtype=np.float32)
+        self._base_alpha = np.zeros(cap, dtype=np.float32)
+        self._visible = np.zeros(cap, dtype=bool)
+        # 全ストロークの点列を1本に連結したプール(_pts_offsetが区切り)
+        # 各Strokeのpoints_xy/pressureはこのプールへのビュー
+        self._pts_cap = 1 << 20
+        self._pts_xy = np.zeros((self._pts_cap, 2), dtype=np.float32)
+        self._pts_pressure = np.zeros(self._pts_cap, dtype=np.float32)
+        self._pts_offset = np.zeros(cap + 1, dtype=np.int64)
+        # time_created順のソート済みインデックス(生存区間の二分探索用)
+        self._tc_order = np.empty(0, dtype=np.int64)
+        self._tc_sorted = np.empty(0, dtype=np.float32)
+        # lamから解析的に決まる「生存地平」(閾値を割るまでの時間)
+        self._horizon_lam = self.lambda_base
+        self._death_horizon = math.log(1.0 / 0.001) / self._horizon_lam
+        # 描画中ストローク用の倍々拡張バッファ (x, y, pressure)
+        self._cur_buf = np.empty((64, 3), dtype=np.float32)
+        self._cur_len = 0
+        # 描画中ストロークのtime_created(押下時点で確定させ、ライブ追記と
+        # 再構築/保存読込のセグメント時刻を常に一致させる)
+        self._cur_t0 = 0.0
+        # 描画中ストロークのポリラインキャッシュ(点数が変わった時だけ作り直す)
+        self._cur_poly = None
+        self._cur_poly_len = 0
+        # 再描画の間引き用(高レート入力対策)
+        self._last_update_ns = 0
+        self.density_w = density_w
+        self.density_h = density_h
+
+        # GPU常駐バッファの状態(initializeGLで実体を確保する)
+        self._vbo_used = 0
+        self._vbo_dirty = True
+
         # moderngl objects
         self.ctx: moderngl.Context = None
         self.fbo = None
@@ -89,7 +140,6 @@ class GLCanvas(QOpenGLWidget):
         # timer for repaint
         self.virtual_time = 0.0
         self.max_virtual_time = 0.0  # 最大値を記録
-        self.last_virtual_time = 0.0 # 前回の時間を記録（巻き戻し検知用）
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.advance_virtual_time)
         self.timeline_update_callback = None
@@ -110,31 +160,127 @@ class GLCanvas(QOpenGLWidget):
 
     def initializeGL(self):
         self.ctx = moderngl.create_context()
-        # dtype="f1"をdtype="f4"に変更
+        # 密度マップは半精度(GL_RGBA16F)で十分: f4比でVRAM帯域と読み戻し量が半減
         self.density_tex = self.ctx.texture(
-            (self.density_w, self.density_h), components=4, dtype="f4"
+            (self.density_w, self.density_h), components=4, dtype="f2"
         )
         self.density_tex.filter = (moderngl.LINEAR, moderngl.LINEAR)
         self.fbo = self.ctx.framebuffer(color_attachments=[self.density_tex])
-        self.prog = self.ctx.program(
-            vertex_shader="""
+        # 平均密度はミップマップ縮約でGPU側で計算し、最上位(1x1)レベルだけ読み戻す
+        self._top_mip = int(math.log2(max(self.density_w, self.density_h)))
+        # セグメント単位のインスタンス描画:
+        # 固定の単位クアッド4頂点に対し、セグメントごとの(端点2つ, 半幅, time_created)を
+        # インスタンス属性で渡し、法線計算とNDC変換は頂点シェーダ側で行う。
+        # 減衰はフラグメントシェーダが alpha = exp(-lam * (time - t)) で計算する。
+        vertex_src = """
             #version 330
-            in vec2 in_pos;
-            void main() { gl_Position = vec4(in_pos, 0.0, 1.0); }
-            """,
+            uniform vec2 u_resolution;
+            in vec2 in_quad;       // (セグメント方向の補間係数, 法線方向の±1)
+            in vec4 in_seg;        // (x0, y0, x1, y1) ピクセル座標
+            in float in_halfw;
+            in float in_t_created;
+            out float v_t_created;
+            void main() {
+                vec2 p0 = in_seg.xy;
+                vec2 p1 = in_seg.zw;
+                vec2 d = p1 - p0;
+                vec2 n = normalize(vec2(-d.y, d.x));
+                vec2 pos = mix(p0, p1, in_quad.x) + n * in_halfw * in_quad.y;
+                vec2 ndc = (pos / u_resolution) * 2.0 - 1.0;
+                ndc.y = -ndc.y;
+                v_t_created = in_t_created;
+                gl_Position = vec4(ndc, 0.0, 1.0);
+            }
+            """
+        self.prog = self.ctx.program(
+            vertex_shader=vertex_src,
             fragment_shader="""
             #version 330
+            uniform float u_time;
+            uniform float u_lam;
+            uniform vec3 u_color;
+            in float v_t_created;
             out vec4 fcol;
-            void main() { fcol = vec4(1.0,1.0,1.0,1.0); }
+            void main() {
+                if (v_t_created > u_time) discard;
+                float a = exp(-u_lam * (u_time - v_t_created));
+                if (a < 0.001) discard;
+                fcol = vec4(u_color, a);
+            }
             """,
         )
+        # 密度集計用プログラム: フラグメントごとにアルファ(8bit量子化)をSSBOへatomic加算し、
+        # テクスチャ読み戻しなしで4バイトのカウンタだけを読む (GL 4.3以降)
+        try:
+            self.prog_density = self.ctx.program(
+                vertex_shader=vertex_src.replace("#version 330", "#version 430"),
+                fragment_shader="""
+                #version 430
+                uniform float u_time;
+                uniform float u_lam;
+                layout(std430, binding = 0) buffer Coverage { uint cov; };
+                in float v_t_created;
+                out vec4 fcol;
+                void main() {
+                    if (v_t_created > u_time) discard;
+                    float a = exp(-u_lam * (u_time - v_t_created));
+                    if (a < 0.001) discard;
+                    atomicAdd(cov, uint(a * 255.0 + 0.5));
+                    fcol = vec4(1.0, 1.0, 1.0, a);
+                }
+                """,
+            )
+        except moderngl.Error:
+            # GL 4.3未満ではSSBOが使えないため、ミップマップ縮約+PBO読み戻しで代替する
+            self.prog_density = None
         self.ctx.enable(moderngl.BLEND)
         self.ctx.blend_func = (moderngl.SRC_ALPHA, moderngl.ONE_MINUS_SRC_ALPHA)
 
+        # 毎フレームのバッファ生成/解放を避けるため、VBO/VAOは一度だけ確保して使い回す
+        # 単位クアッド(トライアングルストリップ4頂点)は一度だけアップロードする
+        quad = np.array([[0, -1], [1, -1], [0, 1], [1, 1]], dtype=np.float32)
+        self._quad_vbo = self.ctx.buffer(quad)
+        # 全セグメントのインスタンスレコードを常駐させる追記専用バッファ
+        # (毎フレームの再構築はせず、新しいセグメントだけを末尾に書き足す)
+        self._vbo = self.ctx.buffer(reserve=4 * 1024 * 1024, dynamic=True)
+        self._vao = self._make_stroke_vao(self.prog)
+        self._vbo_used = 0  # 使用済みバイト数
+        self._vbo_dirty = True  # Trueなら次の描画で全再構築
+
+        # 密度集計カウンタ(SSBO)と、同じ常駐バッファを参照する集計用VAO
+        self._cov_buf = None
+        self._vao_density = None
+        if self.prog_density is not None:
+            # reserve=は内容未定義なので、初回読み出し前にゼロクリアしておく
+            self._cov_buf = self.ctx.buffer(reserve=4)
+            self._cov_buf.clear()
+            self._vao_density = self._make_stroke_vao(self.prog_density)
+
+        # 密度の読み戻しはPBO2枚のリングで二重化する:
+        # 今フレームは転送だけ発行し、前フレームの結果を消費することでGPU同期待ちを無くす
+        self._read_bufs = [self.ctx.buffer(reserve=8) for _ in range(2)]
+        for buf in self._read_bufs:
+            buf.clear()  # 初回フレームは未転送のまま読むため
+        self._read_idx = 0
+
+    def _append_current_point(self, x, y, pressure=1.0):
+        # バッファが足りなくなったら倍に拡張する
+        if self._cur_len >= len(self._cur_buf):
+            buf = np.empty((len(self._cur_buf) * 2, 3), dtype=np.float32)
+            buf[:self._cur_len] = self._cur_buf
+            self._cur_buf = buf
+        self._cur_buf[self._cur_len] = (x, y, pressure)
+        self._cur_len += 1
+
     def mousePressEvent(self, e):
         if e.button() == Qt.MouseButton.LeftButton:
             x, y = e.position().x(), e.position().y()
-            self.current_points = [(x, y, 1.0)]
+            self._cur_len = 0
+            # 前ストロークのポリラインキャッシュを破棄する(再構築ガードは点数だけを
+            # 見るので、点数が偶然一致すると前ストロークが1フレーム描かれてしまう)
+            self._cur_poly = None
+            self._cur_t0 = self.virtual_time
+            self._append_current_point(x, y)
             self.timer.start(33)
             # 再生中なら停止
             if self.stop_play_callback:
@@ -143,154 +289,307 @@ class GLCanvas(QOpenGLWidget):
     def mouseMoveEvent(self, e):
         if e.buttons() & Qt.MouseButton.LeftButton:
             x, y = e.position().x(), e.position().y()
-            self.current_points.append((x, y, 1.0))
-            self.update()
+            self._append_current_point(x, y)
+            # 新しいセグメントだけをGPU常駐バッファへ追記する
+            # (time_createdは押下時刻で統一し、再構築後も同じ見た目を保つ)
+            if self.ctx is not None and self._cur_len >= 2:
+                chunk = self._stroke_segments(
+                    self._cur_buf[self._cur_len - 2:self._cur_len, :2],
+                    6.0, self._cur_t0
+                )
+                if chunk is not None:
+                    # paintEvent外でコンテキストを使うのでmake/doneを対で呼ぶ
+                    self.makeCurrent()
+                    self._append_segments_gpu(chunk)
+                    self.doneCurrent()
+            # タブレット等の高レート入力(500Hz超)でも再描画は60Hz相当に間引く
+            # (点の追加とGPUへの追記は全イベントで行うので入力は取りこぼさない)
+            now_ns = time.perf_counter_ns()
+            if now_ns - self._last_update_ns > 15_000_000:
+                self._last_update_ns = now_ns
+                self.update()
+
+    def _grow_stroke_pool(self):
+        # ストロークプールが高水位に達したら倍に拡張する
+        cap = len(self._time_created) * 2
+        for name in ("_time_created", "_base_alpha", "_visible"):
+            old = getattr(self, name)
+            new = np.zeros(cap, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        new_off = np.zeros(cap + 1, dtype=np.int64)
+        new_off[:len(self._pts_offset)] = self._pts_offset
+        self._pts_offset = new_off
+
+    def _grow_point_pool(self):
+        # 点プールが尽きたら倍に拡張し、既存ストロークのビューを張り直す
+        self._pts_cap *= 2
+        new_xy = np.zeros((self._pts_cap, 2), dtype=np.float32)
+        new_xy[:len(self._pts_xy)] = self._pts_xy
+        new_pr = np.zeros(self._pts_cap, dtype=np.float32)
+        new_pr[:len(self._pts_pressure)] = self._pts_pressure
+        self._pts_xy = new_xy
+        self._pts_pressure = new_pr
+        for i, s in enumerate(self.strokes):
+            o0, o1 = int(self._pts_offset[i]), int(self._pts_offset[i + 1])
+            s.points_xy = self._pts_xy[o0:o1]
+            s.pressure = self._pts_pressure[o0:o1]
+
+    def _pool_append_stroke(self, points_xy, pressure, width, color, time_created):
+        # プールの末尾に1ストローク分を書き込み、そのビューを持つStrokeを登録する
+        n = self._n_strokes
+        if n >= len(self._time_created):
+            self._grow_stroke_pool()
+        npts = len(points_xy)
+        off = int(self._pts_offset[n])
+        while off + npts > self._pts_cap:
+            self._grow_point_pool()
+        self._pts_xy[off:off + npts] = points_xy
+        self._pts_pressure[off:off + npts] = pressure
+        self._pts_offset[n + 1] = off + npts
+        self._time_created[n] = time_created
+        # アルファと可視フラグは毎フレーム_decay_strokesが導出するので初期値でよい
+        self._base_alpha[n] = 1.0
+        self._visible[n] = True
+        s = Stroke(self._pts_xy[off:off + npts], self._pts_pressure[off:off + npts],
+                   width, color, time_created)
+        self.strokes.append(s)
+        self._n_strokes = n + 1
+        return s
+
+    def _resort_times(self):
+        # タイムリープで過去に描くとtime_createdは追加順に単調でないため都度ソートする
+        self._tc_order = np.argsort(self._time_created[:self._n_strokes], kind="stable")
+        self._tc_sorted = self._time_created[self._tc_order]
 
     def mouseReleaseEvent(self, e):
-        if e.button() == Qt.MouseButton.LeftButton and len(self.current_points) >= 2:
-            s = Stroke(self.current_points.copy(), 6.0, (0, 0, 0), self.virtual_time)
-            self.strokes.append(s)
-            self.current_points = []
+        if e.button() == Qt.MouseButton.LeftButton and self._cur_len >= 2:
+            pts = self._cur_buf[:self._cur_len]
+            self._pool_append_stroke(pts[:, :2], pts[:, 2], 6.0, (0, 0, 0), self._cur_t0)
+            self._resort_times()
+            self._cur_len = 0
             # 最大virtual_timeを更新
             if self.virtual_time > self.max_virtual_time:
                 self.max_virtual_time = self.virtual_time
-            self.timer.stop() 
+            self.timer.stop()
+
+    def _stroke_segments(self, points_xy, width, t_created):
+        # セグメントごとに1インスタンスレコード(x0, y0, x1, y1, 半幅, time_created)を作る
+        # ピクセル座標のまま渡し、法線計算とNDC変換は頂点シェーダが行う
+        # (解像度に依存しないため、リサイズでもキャッシュは無効化不要)
+        p = points_xy
+        d = p[1:] - p[:-1]
+        keep = np.hypot(d[:, 0], d[:, 1]) >= 1e-6
+        if not keep.any():
+            return None
+        rec = np.empty((int(keep.sum()), 6), dtype=np.float32)
+        rec[:, 0:2] = p[:-1][keep]
+        rec[:, 2:4] = p[1:][keep]
+        rec[:, 4] = width / 2.0
+        rec[:, 5] = t_created
+        return rec
+
+    def _rebuild_stroke_vbo(self):
+        # 常駐バッファを全ストロークのキャッシュ済みレコードから作り直す
+        # (インポート/クリア/容量拡張時のみ通る低頻度パス)
+        chunks = []
+        for s in self.strokes:
+            if len(s) < 2:
+                continue
+            if s._seg_cache is None:
+                rec = self._stroke_segments(s.points_xy, s.width, s.time_created)
+                if rec is None:
+                    rec = np.empty((0, 6), dtype=np.float32)
+                s._seg_cache = rec
+            if s._seg_cache.size:
+                chunks.append(s._seg_cache)
+        data = np.concatenate(chunks) if chunks else np.empty((0, 6), dtype=np.float32)
+        if data.nbytes > self._vbo.size:
+            self._vbo.orphan(size=max(self._vbo.size * 2, data.nbytes))
+        if data.size:
+            self._vbo.write(data, offset=0)
+        self._vbo_used = data.nbytes
+        self._vbo_dirty = False
+
+    def _make_stroke_vao(self, prog):
+        # 常駐バッファを参照するVAOを作る(バッファ拡張で作り直す時にも使う)
+        return self.ctx.vertex_array(
+            prog,
+            [
+                (self._quad_vbo, "2f", "in_quad"),
+                (self._vbo, "4f 1f 1f /i", "in_seg", "in_halfw", "in_t_created"),
+            ],
+        )
+
+    def _grow_vbo(self, needed):
+        # 追記済みの内容(描画中ストロークのライブセグメントを含む)を保ったまま
+        # 大きいバッファへコピーして拡張し、参照しているVAOを作り直す
+        new_vbo = self.ctx.buffer(reserve=max(self._vbo.size * 2, needed), dynamic=True)
+        self.ctx.copy_buffer(new_vbo, self._vbo, size=self._vbo_used)
+        self._vbo.release()
+        self._vbo = new_vbo
+        self._vao.release()
+        self._vao = self._make_stroke_vao(self.prog)
+        if self._vao_density is not None:
+            self._vao_density.release()
+            self._vao_density = self._make_stroke_vao(self.prog_density)
+
+    def _append_segments_gpu(self, chunk):
+        # 新しいセグメント分だけを常駐バッファの末尾に追記する
+        if self._vbo_used + chunk.nbytes > self._vbo.size:
+            self._grow_vbo(self._vbo_used + chunk.nbytes)
+        self._vbo.write(chunk, offset=self._vbo_used)
+        self._vbo_used += chunk.nbytes
 
     def render_density_map(self):
         self.fbo.use()
         self.ctx.clear(0.0, 0.0, 0.0, 0.0)
 
-        verts = []
-        for s in self.strokes:
-            if not s.is_visible:
-                continue
-            if s.time_created > self.virtual_time:
-                continue
-            if len(s.points) < 2:
-                continue
-            cw, ch = self.width(), self.height()
-            for i in range(len(s.points) - 1):
-                x0, y0, _ = s.points[i]
-                x1, y1, _ = s.points[i + 1]
-                dx, dy = x1 - x0, y1 - y0
-                seg_len = math.hypot(dx, dy)
-                if seg_len < 1e-6:
-                    continue
-                nx, ny = -dy / seg_len, dx / seg_len
-                half_w = s.width / 2.0
-                u0, v0 = x0 / cw, 1.0 - (y0 / ch)
-                u1, v1 = x1 / cw, 1.0 - (y1 / ch)
-                ndc0 = (u0 * 2 - 1, v0 * 2 - 1)
-                ndc1 = (u1 * 2 - 1, v1 * 2 - 1)
-                hwx = (half_w / cw) * 2
-                hwy = (half_w / ch) * 2
-                off = (nx * hwx, ny * hwy)
-                v0a = (ndc0[0] + off[0], ndc0[1] + off[1])
-                v0b = (ndc0[0] - off[0], ndc0[1] - off[1])
-                v1a = (ndc1[0] + off[0], ndc1[1] + off[1])
-                v1b = (ndc1[0] - off[0], ndc1[1] - off[1])
-                verts += [
-                    *v0a, *v1a, *v0b,
-                    *v1a, *v1b, *v0b
-                ]
-        if not verts:
+        if self._vbo_dirty:
+            self._rebuild_stroke_vbo()
+        if self._vbo_used == 0:
             return None
-
-        vdata = np.array(verts, dtype="f4")
-        vbo = self.ctx.buffer(vdata.tobytes())
-        vao = self.ctx.simple_vertex_array(self.prog, vbo, "in_pos")
-        vao.render(moderngl.TRIANGLES)
-        vbo.release()
-        vao.release()
-
-        data = self.density_tex.read()
-        arr = np.frombuffer(data, dtype=np.float32).reshape(
-            (self.density_h, self.density_w, 4)
-        )
-        return np.clip(arr[..., 3], 0.0, 1.0)
+        n_inst = self._vbo_used // 24
+        lam = self.lambda_base * self.lambdas_factor
+
+        if self.prog_density is not None:
+            # SSBOへのatomic加算で集計する: 読むのは4バイトのカウンタだけ。
+            # 前フレームの集計値を先に読んでから今フレーム分を描く(1フレーム遅延)
+            cov = struct.unpack("<I", self._cov_buf.read())[0]
+            self._cov_buf.clear()
+            self._cov_buf.bind_to_storage_buffer(0)
+            self.prog_density["u_resolution"].value = (float(self.width()), float(self.height()))
+            self.prog_density["u_time"].value = self.virtual_time
+            self.prog_density["u_lam"].value = lam
+            self._vao_density.render(moderngl.TRIANGLE_STRIP, vertices=4, instances=n_inst)
+            # 次フレームのread()がatomic加算の結果を確実に見えるようバリアを張る
+            self.ctx.memory_barrier()
+            # アルファは8bit量子化で加算しているので255で割って正規化する
+            return min(1.0, cov / (255.0 * self.density_w * self.density_h))
+
+        # フォールバック: 描画してミップマップ縮約の1x1を読む(f2で8B/フレーム)
+        # (未来・消滅済みストロークはシェーダのdiscardが除外する)
+        self.prog["u_resolution"].value = (float(self.width()), float(self.height()))
+        self.prog["u_time"].value = self.virtual_time
+        self.prog["u_lam"].value = lam
+        self.prog["u_color"].value = (1.0, 1.0, 1.0)
+        self._vao.render(moderngl.TRIANGLE_STRIP, vertices=4, instances=n_inst)
+        self.density_tex.build_mipmaps()
+        # 今フレーム分はPBOへ非同期転送し、前フレーム分を読む(1フレーム遅延)
+        self.density_tex.read_into(self._read_bufs[self._read_idx], level=self._top_mip)
+        mean_px = np.frombuffer(self._read_bufs[1 - self._read_idx].read(), dtype=np.float16)
+        self._read_idx = 1 - self._read_idx
+        return float(np.clip(mean_px[3], 0.0, 1.0))
+
+    def render_strokes_to_screen(self):
+        # 確定済みストロークを常駐バッファから画面へ1ドローで描画する
+        # (減衰はシェーダが計算するため、Qt側のストロークごとの描画は不要)
+        if self._vbo_used == 0:
+            return
+        screen = self.ctx.detect_framebuffer(self.defaultFramebufferObject())
+        screen.use()
+        self.prog["u_resolution"].value = (float(self.width()), float(self.height()))
+        self.prog["u_time"].value = self.virtual_time
+        self.prog["u_lam"].value = self.lambda_base * self.lambdas_factor
+        self.prog["u_color"].value = (0.0, 0.0, 0.0)
+        self._vao.render(moderngl.TRIANGLE_STRIP, vertices=4, instances=self._vbo_used // 24)
+
+    def _decay_strokes(self, now, lam):
+        # lamが変わった時だけ生存地平(閾値0.001を割るまでの時間)を再計算する
+        if abs(lam - self._horizon_lam) > 1e-9:
+            self._death_horizon = math.log(1.0 / 0.001) / lam
+            self._horizon_lam = lam
+        # 可視性とアルファは毎フレーム生存区間から解析的に導き直す。
+        # シェーダも現在のlamでexpを再計算するため、CPU側に死亡のラッチを
+        # 持つとlamが下がった時に両者の忘却結果が食い違ってしまう
+        lo, hi = self._active_window(now)
+        n = self._n_strokes
+        self._base_alpha[:n] = 0.0
+        self._visible[:n] = False
+        idx = self._tc_order[lo:hi]
+        self._visible[idx] = True
+        self._base_alpha[idx] = np.exp(-lam * (now - self._time_created[idx]))
+
+    def _active_window(self, now):
+        # 生存区間 [now - horizon, now] に収まるストロークの
+        # ソート済みインデックス範囲を二分探索で求める
+        lo = int(np.searchsorted(self._tc_sorted, now - self._death_horizon))
+        hi = int(np.searchsorted(self._tc_sorted, now, side="right"))
+        return lo, hi
 
     def paintEvent(self, event):
-        # 巻き戻し検知: 時間が戻ったら、死んだストロークを復活させる可能性があるため全チェック
-        if self.virtual_time < self.last_virtual_time:
-            for s in self.strokes:
-                s.is_visible = True
-
         painter = QPainter(self)
         painter.fillRect(self.rect(), QColor(255, 255, 255))
         painter.end()
         density = self.render_density_map()
-        global_density = float(np.mean(density)) if density is not None else 0.0
+        global_density = density if density is not None else 0.0
+        # 密度は非同期読み戻しのため1フレーム前の値だが、ホメオスタシス制御には十分
         error = global_density - self.target_density
         gain = 0.0 if abs(error) < self.hysteresis else error
         self.lambdas_factor = 1.0 + self.lambda_k * gain
         self.lambdas_factor = max(0.1, min(4.0, self.lambdas_factor))
 
         now = self.virtual_time
-        for s in self.strokes:
-            # 最適化: 完全に消えた(is_visible=False)ものは計算しない
-            if not s.is_visible:
-                continue
+        if len(self.strokes):
+            self._decay_strokes(now, self.lambda_base * self.lambdas_factor)
 
-            age = now - s.time_created
-            if age < 0:
-                s.base_alpha = 0.0
-                continue
-
-            lam = self.lambda_base * self.lambdas_factor
-            s.base_alpha = math.exp(-lam * age)
-            
-            # 閾値を下回ったら不可視フラグを立てて計算除外
-            if s.base_alpha < 0.001:
-                s.base_alpha = 0.0
-                s.is_visible = False
-        
-        self.last_virtual_time = now
+        # 確定済みストロークはGLの1ドローで描画する(Qtの描画呼び出しはストローク数に比例しない)
+        self.render_strokes_to_screen()
 
         painter = QPainter(self)
         painter.setRenderHint(QPainter.RenderHint.Antialiasing)
         pen = QPen(QColor(0, 0, 0))
-        for idx, s in enumerate(self.strokes):
-            if s.base_alpha < 0.01:
+        # 段ハイライト中のストロークだけQtで上描きする(目立つ青色)
+        cw, ch = self.width(), self.height()
+        for idx in self.highlight_stroke_indices:
+            if not (0 <= idx < len(self.strokes)):
+                continue
+            if self._base_alpha[idx] < 0.01:
+                continue
+            s = self.strokes[idx]
+            x0, y0, x1, y1 = s.bbox()
+            m = s.width  # ペン幅ぶんのマージン
+            if x1 + m < 0 or y1 + m < 0 or x0 - m > cw or y0 - m > ch:
                 continue
-            path = QPainterPath()
-            pts = s.points
-            path.moveTo(QPointF(pts[0][0], pts[0][1]))
-            for i in range(1, len(pts) - 1):
-                x1, y1, _ = pts[i]
-                x2, y2, _ = pts[i + 1]
-                cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
-                path.quadTo(QPointF(x1, y1), QPointF(cx, cy))
             pen.setWidthF(s.width)
-            # 段ハイライト中はより目立つ青色
-            if idx in self.highlight_stroke_indices:
-                c = QColor(0, 180, 255)
-            else:
-                c = QColor(0, 0, 0)
-            c.setAlpha(int(255 * np.clip(s.base_alpha, 0.0, 1.0)))
+            # GLパスが描いた黒の上に重ねるため、半透明合成ではなく不透明ペンで
+            # 置き換える。白背景へのアルファ合成をペン色に織り込んでおくことで
+            # 「減衰に合わせて薄くなる青」の見た目は元のまま保つ
+            a = float(np.clip(self._base_alpha[idx], 0.0, 1.0))
+            w = 255.0 * (1.0 - a)
+            c = QColor(int(w), int(w + 180.0 * a), int(w + 255.0 * a))
             pen.setColor(c)
             painter.setPen(pen)
-            painter.drawPath(path)
-
-        if self.current_points:
-            path = QPainterPath()
-            path.moveTo(QPointF(self.current_points[0][0], self.current_points[0][1]))
-            for i in range(1, len(self.current_points) - 1):
-                x1, y1, _ = self.current_points[i]
-                x2, y2, _ = self.current_points[i + 1]
-                cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
-                path.quadTo(QPointF(x1, y1), QPointF(cx, cy))
+            painter.drawPolyline(s.polyline())
+
+        if self._cur_len > 0:
+            # 描画中ストロークのポリラインは点が増えたフレームだけ作り直す
+            if self._cur_poly is None or self._cur_poly_len != self._cur_len:
+                self._cur_poly = midpoint_polyline(self._cur_buf[:self._cur_len, :2])
+                self._cur_poly_len = self._cur_len
             pen.setWidthF(6.0)
+            pen.setColor(QColor(0, 0, 0))
             painter.setPen(pen)
-            painter.drawPath(path)
+            painter.drawPolyline(self._cur_poly)
         painter.end()
         # print(f"[DEBUG] global_density={global_density:.4f}, lambda_factor={self.lambdas_factor:.3f}")
 
     def clear_all(self):
+        # プールは確保したまま、カーソルを先頭へ戻すだけでよい
         self.strokes = []
-        self.current_points = []
+        self._n_strokes = 0
+        self._resort_times()
+        self._cur_len = 0
+        # 常駐バッファも使用量を即座にゼロへ(再構築を待つと、その間に
+        # 追記されたライブセグメントが再構築で消えてしまう)
+        self._vbo_used = 0
+        self._vbo_dirty = False
+        # ドラッグ中のクリアに備えて押下時刻もリセットし、タイマーも止める
+        # (古い_cur_t0のままだと、残りの追記が未来時刻で刻まれてしまう)
+        self._cur_t0 = 0.0
+        self.timer.stop()
         self.virtual_time = 0.0
         self.max_virtual_time = 0.0
-        self.last_virtual_time = 0.0
 
     def export_strokes_json(self):
         # strokesデータとvirtual_timeをJSON文字列で返す
@@ -298,13 +597,13 @@ class GLCanvas(QOpenGLWidget):
             "virtual_time": self.virtual_time,
             "strokes": [
                 {
-                    "points": s.points,
+                    "points": np.column_stack([s.points_xy, s.pressure]).tolist(),
                     "width": s.width,
                     "color": s.color,
                     "time_created": s.time_created,
-                    "base_alpha": s.base_alpha
+                    "base_alpha": float(self._base_alpha[i])
                 }
-                for s in self.strokes
+                for i, s in enumerate(self.strokes)
             ]
         }
         return json.dumps(data)
@@ -313,17 +612,70 @@ class GLCanvas(QOpenGLWidget):
         # JSON文字列からstrokesデータとvirtual_timeを復元
         data = json.loads(json_str)
         self.virtual_time = data.get("virtual_time", 0.0)
-        self.max_virtual_time = max(self.virtual_time, max([s["time_created"] for s in data.get("strokes", [])], default=0.0))
-        self.strokes = [
-            Stroke(
-                points=[tuple(p) for p in d["points"]],
-                width=d["width"],
-                color=tuple(d["color"]),
-                time_created=d["time_created"],
-                base_alpha=d.get("base_alpha", 1.0)
+        self.strokes = []
+        self._n_strokes = 0
+        for d in data.get("strokes", []):
+            pts = np.asarray(d["points"], dtype=np.float32).reshape(-1, 3)
+            self._pool_append_stroke(
+                pts[:, :2], pts[:, 2], d["width"], tuple(d["color"]),
+                d["time_created"], d.get("base_alpha", 1.0)
             )
-            for d in data.get("strokes", [])
-        ]
+        self._resort_times()
+        self._update_max_virtual_time()
+        self._vbo_dirty = True
+        self.update()
+
+    def _update_max_virtual_time(self):
+        # SoA配列のSIMD縮約で求める(Pythonのmax/ジェネレータより速い)
+        n = self._n_strokes
+        self.max_virtual_time = max(
+            self.virtual_time,
+            float(self._time_created[:n].max()) if n else 0.0,
+        )
+
+    def export_strokes_bytes(self):
+        # バイナリ形式: b"TLMB" + ヘッダ長(uint32) + JSONヘッダ + 全ストローク連結のf4配列
+        # 点列を文字列化せずバイト列のまま書き出す(JSON比でサイズ約1/5、パースも不要)
+        header = {"virtual_time": self.virtual_time, "strokes": []}
+        arrays = []
+        offset = 0
+        for i, s in enumerate(self.strokes):
+            header["strokes"].append({
+                "offset": offset,
+                "npoints": len(s),
+                "width": s.width,
+                "color": list(s.color),
+                "time_created": s.time_created,
+                "base_alpha": float(self._base_alpha[i]),
+            })
+            arrays.append(np.column_stack([s.points_xy, s.pressure]))
+            offset += len(s)
+        data = np.concatenate(arrays) if arrays else np.empty((0, 3), dtype=np.float32)
+        hjson = json.dumps(header).encode("utf-8")
+        return b"TLMB" + struct.pack("<I", len(hjson)) + hjson + data.astype(np.float32).tobytes()
+
+    def import_strokes_bytes(self, blob):
+        # 先頭バイトで形式を判別する(旧JSON形式は'{'で始まる)
+        if blob[:1] == b"{":
+            self.import_strokes_json(blob.decode("utf-8"))
+            return
+        if blob[:4] != b"TLMB":
+            raise ValueError("unknown strokes file format")
+        hlen = struct.unpack("<I", blob[4:8])[0]
+        header = json.loads(blob[8:8 + hlen].decode("utf-8"))
+        pts_all = np.frombuffer(blob[8 + hlen:], dtype=np.float32).reshape(-1, 3)
+        self.virtual_time = header.get("virtual_time", 0.0)
+        self.strokes = []
+        self._n_strokes = 0
+        for d in header.get("strokes", []):
+            pts = pts_all[d["offset"]:d["offset"] + d["npoints"]]
+            self._pool_append_stroke(
+                pts[:, :2], pts[:, 2], d["width"], tuple(d["color"]),
+                d["time_created"], d.get("base_alpha", 1.0)
+            )
+        self._resort_times()
+        self._update_max_virtual_time()
+        self._vbo_dirty = True
         self.update()
 
 
@@ -659,23 +1011,30 @@ class MainWindow(QMainWindow):
         self.play_button.setText("▶")
 
     def export_strokes(self):
-        path, _ = QFileDialog.getSaveFileName(self, "エクスポート", os.path.join(self.last_folder, "strokes.json"), "JSON Files (*.json)")
+        path, _ = QFileDialog.getSaveFileName(
+            self, "エクスポート", os.path.join(self.last_folder, "strokes.tlm"),
+            "TimeLeapMemo Files (*.tlm);;JSON Files (*.json)")
         if path:
             folder = os.path.dirname(path)
             self.save_last_folder(folder)
-            json_str = self.canvas.export_strokes_json()
-            with open(path, "w", encoding="utf-8") as f:
-                f.write(json_str)
+            # .jsonを選んだ場合のみ互換用のテキスト形式で書き出す
+            if path.lower().endswith(".json"):
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(self.canvas.export_strokes_json())
+            else:
+                with open(path, "wb") as f:
+                    f.write(self.canvas.export_strokes_bytes())
             self.update_timeline_history()
 
     def import_strokes(self):
-        path, _ = QFileDialog.getOpenFileName(self, "インポート", self.last_folder, "JSON Files (*.json)")
+        path, _ = QFileDialog.getOpenFileName(
+            self, "インポート", self.last_folder, "TimeLeapMemo Files (*.tlm *.json)")
         if path:
             folder = os.path.dirname(path)
             self.save_last_folder(folder)
-            with open(path, "r", encoding="utf-8") as f:
-                json_str = f.read()
-            self.canvas.import_strokes_json(json_str)
+            with open(path, "rb") as f:
+                blob = f.read()
+            self.canvas.import_strokes_bytes(blob)
             # 仮想時間に合わせてタイムラインバーも更新
             t = self.canvas.virtual_time
             slider_val = int(t / self.timeline_max * self.timeline_slider.maximum())